@@ -1,28 +1,178 @@
 import os
 import sys
-import h5py
+import weakref
 import numpy as np
-import scipy as sp
 from collections import OrderedDict
-from sklearn import cluster
 from simdat.core import image
 from simdat.core import ml
-from keras import regularizers
-from keras.models import Sequential
-# from keras.models import Graph
-from keras.models import Model
-from keras.layers import Input, Activation, merge
-from keras.layers import Flatten, Dense, Dropout
-from keras.layers import Convolution2D, MaxPooling2D
-from keras.layers import ZeroPadding2D
-from keras.layers import AveragePooling2D
-from keras.utils import np_utils
+
+# keras (and thus theano) is imported by the methods which need it, so that
+# importing this module, e.g. for ImageNet.find_topk, stays cheap
+
+# VGG-16 topology as (stack, [(keras layer name, args, kwargs)]),
+# the layers are instantiated by DPModel._build_layers
+_VGG16_SPEC = [
+    ('conv1', [
+        ('ZeroPadding2D', ((1, 1),), {'input_shape': (3, 224, 224)}),
+        ('Convolution2D', (64, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (64, 3, 3), {'activation': 'relu'}),
+        ('MaxPooling2D', ((2, 2),), {'strides': (2, 2)})
+    ]),
+    ('conv2', [
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (128, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (128, 3, 3), {'activation': 'relu'}),
+        ('MaxPooling2D', ((2, 2),), {'strides': (2, 2)})
+    ]),
+    ('conv3', [
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (256, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (256, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (256, 3, 3), {'activation': 'relu'}),
+        ('MaxPooling2D', ((2, 2),), {'strides': (2, 2)})
+    ]),
+    ('conv4', [
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('MaxPooling2D', ((2, 2),), {'strides': (2, 2)})
+    ]),
+    ('conv5', [
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('ZeroPadding2D', ((1, 1),), {}),
+        ('Convolution2D', (512, 3, 3), {'activation': 'relu'}),
+        ('MaxPooling2D', ((2, 2),), {'strides': (2, 2)})
+    ]),
+    ('fc', [
+        ('Flatten', (), {}),
+        ('Dense', (4096,), {'activation': 'relu'}),
+        ('Dropout', (0.5,), {}),
+        ('Dense', (4096,), {'activation': 'relu'}),
+        ('Dropout', (0.5,), {})
+    ]),
+    ('classify', [
+        ('Dense', (1000,), {'activation': 'softmax'})
+    ])
+]
+
+
+def _bilinear_matrix(n_src, n_dst):
+    ''' Interpolation matrix of shape (n_dst, n_src) reproducing the
+        bilinear resize of PIL (used by scipy.misc.imresize) along one axis
+    '''
+    scale = float(n_src) / n_dst
+    pos = np.clip((np.arange(n_dst) + 0.5) * scale - 0.5, 0, n_src - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, n_src - 1)
+    frac = pos - lo
+    w = np.zeros((n_dst, n_src), dtype=np.float32)
+    rows = np.arange(n_dst)
+    w[rows, lo] += 1 - frac
+    w[rows, hi] += frac
+    return w
+
+
+def _bilinear_weights(src, dst):
+    ''' Row and column weights to resize a (h, w) map to dst
+
+    @param src: (h, w) of the input maps
+    @param dst: (h, w) of the output maps
+
+    @return Wy, Wx such that Wy . fmap . Wx.T is the resized map
+
+    '''
+    return _bilinear_matrix(src[0], dst[0]), _bilinear_matrix(src[1], dst[1])
+
+
+def _kmeans2_run(X, sq, total, rng, n_iter):
+    ''' One k-means++ seeded run of _kmeans2
+
+    @return labels, inertia (within-cluster sum of squares)
+
+    '''
+    n = X.shape[0]
+    c0 = X[rng.randint(n)]
+    # k-means++: pick the second center with probability ~ distance^2
+    d = np.maximum(sq - 2 * X.dot(c0) + c0.dot(c0), 0).astype(np.float64)
+    if d.sum() == 0:
+        return np.zeros(n, dtype=bool), 0.0
+    c1 = X[rng.choice(n, p=d / d.sum())]
+    labels = X.dot(c1 - c0) > (c1.dot(c1) - c0.dot(c0)) / 2
+    for i in range(n_iter):
+        n1 = np.count_nonzero(labels)
+        if n1 == 0 or n1 == n:
+            break
+        s1 = labels.astype(X.dtype).dot(X)
+        c1 = s1 / n1
+        c0 = (total - s1) / (n - n1)
+        _labels = X.dot(c1 - c0) > (c1.dot(c1) - c0.dot(c0)) / 2
+        if np.array_equal(_labels, labels):
+            break
+        labels = _labels
+    # sum of squares around the means of the final partition
+    n1 = np.count_nonzero(labels)
+    s1 = labels.astype(X.dtype).dot(X).astype(np.float64)
+    s0 = total.astype(np.float64) - s1
+    inertia = sq.sum(dtype=np.float64)
+    if n1 > 0:
+        inertia -= s1.dot(s1) / n1
+    if n1 < n:
+        inertia -= s0.dot(s0) / (n - n1)
+    return labels, inertia
+
+
+def _kmeans2(X, n_iter=300, n_init=10, seed=0):
+    ''' Lloyd's algorithm specialised for two clusters
+
+    With two centers c0 and c1, a sample x is closer to c1 iff
+    x . (c1 - c0) > (|c1|^2 - |c0|^2) / 2, so each iteration costs one
+    matrix-vector product instead of a full distance matrix.
+
+    @param X: samples of shape (n_samples, n_features). The centers are
+              kept in the dtype of X, so float32 input stays float32.
+              A centered copy of X is made.
+
+    Keyword arguments:
+    n_iter -- maximum number of iterations per run (default: 300)
+    n_init -- number of k-means++ seeded runs, the one with the lowest
+              inertia is kept (default: 10, as sklearn's KMeans)
+    seed   -- seed of the k-means++ initialization (default: 0)
+
+    @return labels: array of 0/1 of shape (n_samples,)
+
+    '''
+    rng = np.random.RandomState(seed)
+    # k-means is translation invariant: centering once avoids the float32
+    # cancellation in the distances and in the inertia of large offsets
+    X = X - X.mean(axis=0, dtype=np.float64).astype(X.dtype)
+    sq = np.einsum('ij,ij->i', X, X)
+    total = X.sum(axis=0)
+    best = None
+    best_inertia = None
+    for i in range(max(n_init, 1)):
+        labels, inertia = _kmeans2_run(X, sq, total, rng, n_iter)
+        if best is None or inertia < best_inertia:
+            best = labels
+            best_inertia = inertia
+    return best.astype(int)
 
 
 class DP:
     def __init__(self):
         self.im = image.IMAGE()
         self.mlr = ml.MLRun()
+        self._hc_fns = {}
+        self._resize_cache = {}
         self.dp_init()
 
     def dp_init(self):
@@ -33,6 +183,7 @@ class DP:
         """ Get Cifar10 data """
 
         from keras.datasets import cifar10
+        from keras.utils import np_utils
         (X_train, y_train), (X_test, y_test) = cifar10.load_data()
         print('X_train shape:', X_train.shape)
         print(X_train.shape[0], 'train samples')
@@ -52,6 +203,7 @@ class DP:
         """ Get MNIST data """
 
         from keras.datasets import mnist
+        from keras.utils import np_utils
 
         (X_train, y_train), (X_test, y_test) = mnist.load_data()
 
@@ -74,6 +226,7 @@ class DP:
     def visualize_model(self, model, to_file='model.png'):
         '''Visualize model (work with Keras 1.0)'''
 
+        from keras.models import Sequential, Model
         if type(model) == Sequential or type(model) == Model:
             from keras.utils.visualize_util import plot
             plot(model, to_file=to_file)
@@ -97,26 +250,138 @@ class DP:
 
             graph.write_png(to_file)
 
-    def extract_hypercolumn(self, model, la_idx, instance):
+    def _get_feature_fn(self, model, la_idx, linker=None, resize=False):
+        ''' Compile (once) the theano function which outputs the
+            feature maps of the layers la_idx of the model.
+            If resize is True, the maps are upscaled to 224x224 and
+            concatenated within the graph as a single (224*224, C)
+            output. The functions are cached with a weak reference to
+            their model, so a freed model (whose id may be reused) is
+            never matched and its function can be released. '''
+
+        import theano
+        key = (id(model), tuple(la_idx), linker, resize)
+        cached = self._hc_fns.get(key)
+        if cached is not None and cached[0]() is model:
+            return cached[1]
+        # drop the functions of the models which no longer exist
+        for k in [k for k, v in self._hc_fns.items() if v[0]() is None]:
+            del self._hc_fns[k]
+        layers = [model.layers[li].get_output(train=False)
+                  for li in la_idx]
+        if resize:
+            layers = [self._upsample_hc(model.layers[li], l)
+                      for li, l in zip(la_idx, layers)]
+            hc = theano.tensor.concatenate(layers, axis=1)[0]
+            layers = [hc.dimshuffle(1, 2, 0).reshape((224 * 224, -1))]
+        mode = None
+        if linker is not None:
+            # Mode.clone() ignores a linker argument, build the mode instead
+            default = theano.compile.get_default_mode()
+            mode = theano.compile.Mode(
+                linker=linker, optimizer=default.provided_optimizer)
+        get_feature = theano.function([model.layers[0].input], layers,
+                                      allow_input_downcast=False,
+                                      mode=mode)
+        get_feature.trust_input = True
+        self._hc_fns[key] = (weakref.ref(model), get_feature)
+        return get_feature
+
+    def _upsample_hc(self, layer, output, size=224):
+        ''' Symbolic bilinear upsampling of the layer output to size '''
+
+        from theano.tensor.nnet.abstract_conv import bilinear_upsampling
+        h = layer.output_shape[-1]
+        if size % h != 0:
+            print('ERROR: Cannot upsample %s from %i to %i on device.'
+                  % (layer.get_config()['name'], h, size))
+            sys.exit(1)
+        if h == size:
+            return output
+        return bilinear_upsampling(output, ratio=size // h,
+                                   use_1D_kernel=True)
+
+    def _get_resize_weights(self, src, dst=(224, 224)):
+        ''' Bilinear weights (Wy, Wx) to resize src to dst,
+            computed once per pair of shapes '''
+
+        key = (tuple(src), tuple(dst))
+        ww = self._resize_cache.get(key)
+        if ww is None:
+            ww = _bilinear_weights(src, dst)
+            self._resize_cache[key] = ww
+        return ww
+
+    def _upscale_hc(self, task):
+        ''' Upscale the feature maps of one layer to 224x224
+
+        @param task: (convmap, out), convmap is the (1, c, h, w) layer
+                     output and out the (224*224, c) block of the
+                     hypercolumns to be filled
+
+        '''
+        convmap, out = task
+        Wy, Wx = self._get_resize_weights(convmap.shape[-2:])
+        # upscale in (y, x, c) order so that the result can be written
+        # directly as columns of the pixel-major output
+        fmaps = convmap[0].astype(np.float32, copy=False)
+        fmaps = fmaps.transpose(1, 2, 0)
+        upscaled = np.matmul(Wx, np.tensordot(Wy, fmaps, axes=(1, 0)))
+        out[...] = upscaled.reshape(224 * 224, -1)
+
+    def extract_hypercolumn(self, model, la_idx, instance, linker=None,
+                            gpu_resize=False, n_jobs=1):
         ''' Extract HyperColumn of pixels (Theano Only)
 
         @param model: input DP model
         @param la_idx: indexes of the layers to be extract
         @param instamce: image instance used to extract the hypercolumns
 
+        Keyword arguments:
+        linker -- theano linker used to compile the feature function,
+                  e.g. cvm_nogc to reuse intermediate buffers between
+                  calls (default: None, use theano.config.linker)
+        gpu_resize -- True to upscale the feature maps within the theano
+                      graph so they never leave the device. It requires
+                      224 to be a multiple of the map sizes and the edges
+                      are interpolated slightly differently from the host
+                      resize (default: False)
+        n_jobs -- number of threads upscaling the layers in parallel
+                  (default: 1)
+
+        @return hypercolumns of shape (224*224, C), one row per pixel
+
         '''
         import theano
-        layers = [model.layers[li].get_output(train=False) for li in la_idx]
-        get_feature = theano.function([model.layers[0].input], layers,
-                                      allow_input_downcast=False)
+        get_feature = self._get_feature_fn(model, la_idx, linker=linker,
+                                           resize=gpu_resize)
+        # trust_input skips the type checks, cast to the expected dtype here
+        instance = np.asarray(instance, dtype=theano.config.floatX)
         feature_maps = get_feature(instance)
-        hypercolumns = []
+        if gpu_resize:
+            return feature_maps[0].astype(np.float32, copy=False)
+        nch = sum(convmap.shape[1] for convmap in feature_maps)
+        hypercolumns = np.empty((224 * 224, nch), dtype=np.float32)
+        tasks = []
+        ch = 0
         for convmap in feature_maps:
-            for fmap in convmap[0]:
-                upscaled = sp.misc.imresize(fmap, size=(224, 224),
-                                            mode="F", interp='bilinear')
-                hypercolumns.append(upscaled)
-        return np.asarray(hypercolumns)
+            nc = convmap.shape[1]
+            tasks.append((convmap, hypercolumns[:, ch:ch + nc]))
+            ch += nc
+        if n_jobs > 1:
+            # the layers write disjoint blocks, and the products release
+            # the GIL, so threads are enough
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes=min(n_jobs, len(tasks)))
+            try:
+                pool.map(self._upscale_hc, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                self._upscale_hc(task)
+        return hypercolumns
 
     def is_dense(self, layer):
         '''Check if the layer is dense (fully connected)
@@ -139,18 +404,21 @@ class DP:
         return None
 
     def cluster_hc(self, hc, n_jobs=1):
-        ''' Use KMeans to cluster hypercolumns'''
-
-        ori_size = hc.shape[1]
-        new_size = ori_size*ori_size
-        m = hc.transpose(1, 2, 0).reshape(new_size, -1)
-        kmeans = cluster.KMeans(n_clusters=2, max_iter=300, n_jobs=n_jobs,
-                                precompute_distances=True)
-        cluster_labels = kmeans .fit_predict(m)
-        imcluster = np.zeros((ori_size, ori_size))
-        imcluster = imcluster.reshape((new_size,))
-        imcluster = cluster_labels
-        return imcluster.reshape(ori_size, ori_size)
+        ''' Use KMeans to cluster hypercolumns into two groups
+
+        @param hc: hypercolumns returned by self.extract_hypercolumn
+
+        Keyword arguments:
+        n_jobs -- not used, kept for backward compatibility
+
+        '''
+        if n_jobs != 1:
+            print('[DP] WARNING: n_jobs is ignored by cluster_hc')
+        ori_size = int(round(np.sqrt(hc.shape[0])))
+        # float32 halves the memory traffic of the distance products
+        m = hc.astype(np.float32, copy=False)
+        cluster_labels = _kmeans2(m, n_iter=300)
+        return cluster_labels.reshape(ori_size, ori_size)
 
     def prepare_data(self, img_loc, width, height, convert_Y=True,
                      rc=False, scale=True, classes=None,
@@ -220,6 +488,7 @@ class DP:
         if scale:
             X /= 255
         if convert_Y:
+            from keras.utils import np_utils
             Y = np_utils.to_categorical(np.array(Y), len(classes))
 
         return np.array(X), np.array(Y), classes, F
@@ -297,69 +566,39 @@ class DPModel(DP):
         """ place holder for child class """
         pass
 
+    def _build_layers(self, spec, skip=()):
+        """ Instantiate the layers described by spec as self.layers
+
+        @param spec: list of (stack, [(keras layer name, args, kwargs)])
+
+        Keyword arguments:
+        skip -- names of the stacks not to be built (default: ())
+
+        """
+        from keras import layers
+        self.layers = OrderedDict()
+        for stack, items in spec:
+            if stack in skip:
+                continue
+            self.layers[stack] = [getattr(layers, name)(*a, **kw)
+                                  for name, a, kw in items]
+        return self.layers
+
+    def _flat_layers(self):
+        """ All layers of self.layers, in order """
+
+        return [l for stack in self.layers for l in self.layers[stack]]
+
     def VGG_16(self, weights_path=None, lastFC=True):
         '''VGG-16 model, source from https://goo.gl/qqM88H'''
 
-        self.layers = OrderedDict([
-            ('conv1', [
-                ZeroPadding2D((1, 1), input_shape=(3, 224, 224)),
-                Convolution2D(64, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(64, 3, 3, activation='relu'),
-                MaxPooling2D((2, 2),  strides=(2, 2))
-            ]),
-            ('conv2', [
-                ZeroPadding2D((1, 1)),
-                Convolution2D(128, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(128, 3, 3, activation='relu'),
-                MaxPooling2D((2, 2), strides=(2, 2))
-            ]),
-            ('conv3', [
-                ZeroPadding2D((1, 1)),
-                Convolution2D(256, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(256, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(256, 3, 3, activation='relu'),
-                MaxPooling2D((2, 2), strides=(2, 2))
-            ]),
-            ('conv4', [
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                MaxPooling2D((2, 2), strides=(2, 2))
-            ]),
-            ('conv5', [
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                ZeroPadding2D((1, 1)),
-                Convolution2D(512, 3, 3, activation='relu'),
-                MaxPooling2D((2, 2), strides=(2, 2))
-            ]),
-            ('fc', [
-                Flatten(),
-                Dense(4096, activation='relu'),
-                Dropout(0.5),
-                Dense(4096, activation='relu'),
-                Dropout(0.5),
-            ]),
-            ('classify', [
-                Dense(1000, activation='softmax')
-            ])
-        ])
-        model = Sequential()
-        for stack in self.layers:
-            if stack == 'classify' and not lastFC:
-                print('[DPModels] Skip the last FC layer')
-                continue
-            for l in self.layers[stack]:
-                model.add(l)
+        skip = ()
+        if not lastFC:
+            print('[DPModels] Skip the last FC layer')
+            skip = ('classify',)
+        from keras.models import Sequential
+        self._build_layers(_VGG16_SPEC, skip=skip)
+        model = Sequential(self._flat_layers())
 
         if weights_path:
             self.load_weights(model, weights_path, lastFC=lastFC)
@@ -380,14 +619,18 @@ class DPModel(DP):
         if lastFC:
             model.load_weights(weights_path)
             return
-        f = h5py.File(weights_path)
-        for k in range(f.attrs['nb_layers']):
-            if k >= len(model.layers):
-                break
-            g = f['layer_{}'.format(k)]
-            weights = [g['param_{}'.format(p)] for p in range(g.attrs['nb_params'])]
-            model.layers[k].set_weights(weights)
-        f.close()
+        import h5py
+        f = h5py.File(weights_path, 'r')
+        try:
+            for k in range(f.attrs['nb_layers']):
+                if k >= len(model.layers):
+                    break
+                g = f['layer_{}'.format(k)]
+                weights = [g['param_{}'.format(p)][()]
+                           for p in range(g.attrs['nb_params'])]
+                model.layers[k].set_weights(weights)
+        finally:
+            f.close()
         return
 
     def Simple(self, cats, img_row=224, img_col=224, conv_size=3,
@@ -406,6 +649,9 @@ class DPModel(DP):
         filter_size -- number of the filters of the first conv layer
 
         '''
+        from keras.models import Sequential
+        from keras.layers import Flatten, Dense, Dropout
+        from keras.layers import Convolution2D, MaxPooling2D
         self.layers = OrderedDict([
             ('conv1', [
                 Convolution2D(filter_size, conv_size, conv_size,
@@ -425,10 +671,7 @@ class DPModel(DP):
                 Dense(cats, activation='softmax')
             ])
         ])
-        model = Sequential()
-        for stack in self.layers:
-            for l in self.layers[stack]:
-                model.add(l)
+        model = Sequential(self._flat_layers())
 
         if weights_path:
             model.load_weights(weights_path)
@@ -437,13 +680,30 @@ class DPModel(DP):
 
 
 class ImageNet(image.IMAGE):
+    def img_init(self):
+        """ init called by the IMAGE class """
+        self._labels = None
+        self._labels_fname = None
+        self._synset = None
+        self._syns = None
+
     def get_labels(self, fname='synset_words.txt'):
-        '''Get ImageNet labels from file'''
+        '''Get ImageNet labels from file (parsed once per file)'''
 
+        if self._labels is not None and self._labels_fname == fname:
+            return self._labels
         if not self.check_exist(fname):
             print('ERROR: Cannot find %s.' % fname)
             sys.exit(1)
-        return np.loadtxt(fname, str, delimiter='\t')
+        self._labels = np.loadtxt(fname, str, delimiter='\t')
+        self._labels_fname = fname
+        # synset ids and synonyms stored as parallel arrays
+        tokens = [l.replace(',', '').split(' ') for l in self._labels]
+        self._synset = np.array([t[0] for t in tokens])
+        self._syns = np.empty(len(tokens), dtype=object)
+        for i, t in enumerate(tokens):
+            self._syns[i] = t[1:]
+        return self._labels
 
     def find_topk(self, prob, labels=None, fname='synset_words.txt', ntop=3):
         ''' Find the categories with highest probabilities
@@ -460,11 +720,19 @@ class ImageNet(image.IMAGE):
                    ['jackfruit', 'jak', 'jack'])}
 
         '''
+        flat = prob.ravel()
+        ntop = min(ntop, flat.size)
+        if ntop <= 0:
+            return {}
+        # O(N) selection of the top ntop, only those are sorted
+        idx = np.argpartition(flat, -ntop)[-ntop:]
+        top_k = idx[np.argsort(flat[idx])[::-1]]
         if labels is None:
-            labels = self.get_labels(fname)
+            self.get_labels(fname)
+            return {int(k): (float(flat[k]), self._synset[k], self._syns[k])
+                    for k in top_k}
         results = {}
-        top_k = prob.flatten().argsort()[-1:-(ntop+1):-1]
         for k in top_k:
             l = labels[k].replace(',', '').split(' ')
-            results[k] = (prob[k], l[0], l[1:])
+            results[int(k)] = (float(flat[k]), l[0], l[1:])
         return results
@@ -1,13 +1,101 @@
 import os
 import sys
 import argparse
+
+# actions of the demo, keep in sync with _ACTION_SPEC
+_ACTIONS = ('compare', 'compare_dir', 'pca', 'predict', 'reps', 'test',
+            'train')
+
+
+def _get_parser():
+    """ Command line parser of the demo """
+
+    parser = argparse.ArgumentParser(
+        description="Simple Openface Demo"
+        )
+    parser.add_argument(
+        "-a", "--action", type=str, default='reps',
+        choices=_ACTIONS,
+        help="Action to be taken reps(default)" +
+             "/train/test/predict/pca/compare_dir/compare"
+        )
+    parser.add_argument(
+        "-c", "--classifier", type=str, default='SVC',
+        help="Classifier to be used SVC(default)/Neighbors/RF"
+        )
+    parser.add_argument(
+        "-p", "--pcut", type=float, default=0.4,
+        help="Probability cut to be applied to the classifier" +
+             " (default: 0.4, used by action=test)"
+        )
+    parser.add_argument(
+        "--mpf", type=str, default='./mapping.json',
+        help="Path of the mapping file which is generated by action=train" +
+             " (default: ./mapping.json, used by action=test/predict/pca)"
+        )
+    parser.add_argument(
+        "--img1", type=str,
+        help="Path of the first image passed to act_compare"
+        )
+    parser.add_argument(
+        "--img2", type=str,
+        help="Path of the first image passed to act_compare"
+        )
+    parser.add_argument(
+        "--model-path", dest='model_path', type=str, default='./',
+        help="Root directory of the model pickle files" +
+             " (default: ./ , used by action=test/predict)"
+        )
+    parser.add_argument(
+        "-d", "--dbpath", type=str, default='/www/database/db/',
+        help="Path of dbs which are generated by action=rep"
+             " (default: /www/database/db/)"
+        )
+    parser.add_argument(
+        "-w", "--workdir", type=str, default=None,
+        help="Working directory where the images are stored." +
+             " (default: $PWD, used by action=predict/compare_dir)"
+        )
+    return parser
+
+
+# act_pca runs one PCA per worker process, so each process should use a
+# single BLAS thread. OMP_NUM_THREADS is read when numpy is imported, so it
+# has to be set here, and only for the pca action: the other actions keep
+# all the threads for act_train and for the torch subprocess started by
+# get_net, which inherits os.environ.
+if __name__ == '__main__':
+    _args, _ = _get_parser().parse_known_args()
+    if _args.action == 'pca':
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
+
 import itertools
+import multiprocessing
 import numpy as np
 from simdat.openface import oftools
 from simdat.core.so import image
 from simdat.core import tools
-from simdat.core import plot
-from simdat.core import ml
+
+
+def _pca_worker(task):
+    """ Principal component analysis of one class, run by act_pca
+        in the worker processes
+
+    @param task: (df, ncomp, pca_method) see DEMO._pca
+
+    @return class name, PCA results
+
+    """
+    from simdat.core import ml
+    df, ncomp, pca_method = task
+    mltl = ml.MLTools()
+    p = df['class'].value_counts().idxmax()
+    data = df['rep'].tolist()
+    if ncomp == 1:
+        pca_data = mltl.PCA(data, ncomp=1, method=pca_method)
+        return p, np.array(pca_data).T[0]
+    pca_data = mltl.PCA(data, method=pca_method)
+    return p, np.array(pca_data).T
 
 
 class DEMO(oftools.OpenFace):
@@ -16,7 +104,8 @@ class DEMO(oftools.OpenFace):
 
         self.im = image.IMAGE()
         self.io = tools.MLIO()
-        self.pl = plot.PLOT()
+        self._pl = None
+        self._mappings = {}
         self.mpath = None
         self.dbs = None
         self.ml = None
@@ -30,6 +119,7 @@ class DEMO(oftools.OpenFace):
                        Can be RF/Neighbors/SVC
 
         """
+        from simdat.core import ml
         if method == 'RF':
             self.ml = ml.RFRun(pfs=['ml.json'])
             self.classifier = method
@@ -40,6 +130,30 @@ class DEMO(oftools.OpenFace):
             self.ml = ml.SVMRun(pfs=['ml.json'])
             self.classifier = 'SVC'
 
+    @property
+    def pl(self):
+        """ PLOT instance, created on first use """
+
+        if self._pl is None:
+            from simdat.core import plot
+            self._pl = plot.PLOT()
+        return self._pl
+
+    def _mapping(self, mpf):
+        """ Parse the mapping file, cached until the file is modified
+            (e.g. rewritten by act_train)
+
+        @param mpf: path of the mapping file
+
+        """
+        path = os.path.abspath(mpf)
+        mtime = os.path.getmtime(path)
+        cached = self._mappings.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, self.io.parse_json(path))
+            self._mappings[path] = cached
+        return cached[1]
+
     def set_dbs(self, dbpath):
         """ Set the dbs. dbs are generated by self.act_rep """
 
@@ -95,20 +209,24 @@ class DEMO(oftools.OpenFace):
                   PCA(default)/Randomized/Sparse
 
         """
-        mltl = ml.MLTools()
-        res = self.read_df(df, dtype='train', group=False, conv=False)
-        p = df['class'].value_counts().idxmax()
-        data = res['data']
+        p, pca_data = _pca_worker((df, ncomp, pca_method))
+        return self._plot_pca(p, pca_data, ncomp=ncomp)
+
+    def _plot_pca(self, p, pca_data, ncomp=2):
+        """ Draw the results of _pca_worker
+
+        @param p: class name
+        @param pca_data: PCA results of the class
+
+        Keyword arguments:
+        ncomp  -- number or components kept (Default: 2)
+
+        """
         fname = p + '_pca.png'
         if ncomp == 1:
-            pca_data = mltl.PCA(data, ncomp=1,
-                                method=pca_method)
-            pca_data = np.array(pca_data).T[0]
             self.pl.histogram(pca_data, fname=fname)
             return p, pca_data
         else:
-            pca_data = mltl.PCA(data, method=pca_method)
-            pca_data = np.array(pca_data).T
             self.pl.plot_points(pca_data[0], pca_data[1], fname=fname,
                                 xmin=-1, xmax=1, ymin=-1, ymax=1)
             return p, [pca_data[0], pca_data[1]]
@@ -148,16 +266,28 @@ class DEMO(oftools.OpenFace):
 
         """
         print('[openface_demo] ncomp = %i' % ncomp)
-        mapping = self.io.parse_json(mpf)
+        mapping = self._mapping(mpf)
         df = self._pick_imgs()
-        all_data = []
-        labels = []
+        tasks = []
         for p in mapping.keys():
             df['class'] = df['class'].astype(type(p))
             _df = df[df['class'] == p]
             if _df.empty:
                 continue
-            p, data = self._pca(_df, ncomp=ncomp, pca_method='PCA')
+            tasks.append((_df, ncomp, 'PCA'))
+        results = []
+        if len(tasks) > 0:
+            pool = multiprocessing.Pool(
+                processes=min(len(tasks), multiprocessing.cpu_count()))
+            try:
+                results = pool.map(_pca_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        all_data = []
+        labels = []
+        for p, pca_data in results:
+            p, data = self._plot_pca(p, pca_data, ncomp=ncomp)
             all_data.append(data)
             labels.append(p)
         if ncomp == 1:
@@ -210,11 +340,17 @@ class DEMO(oftools.OpenFace):
         """
         model = self.read_model(root=model_root)
         res = self.act_reps(dir_path=dir_path)
-        mapping = self.io.parse_json(mpf)
-        for item in res:
-            cl = self.ml.predict(res[item]['rep'], model)['Result'][0]
+        mapping = self._mapping(mpf)
+        inv_mapping = {v: k for k, v in mapping.items()}
+        items = list(res)
+        if len(items) == 0:
+            return
+        # one classifier call for all the faces found
+        data = np.array([res[item]['rep'] for item in items])
+        predicted = self.ml.predict(data, model)['Result']
+        for item, cl in zip(items, predicted):
             print ('[openface_demo] Parsing %s' % res[item]['path'])
-            print [c for c in mapping if mapping[c] == cl][0]
+            print inv_mapping[cl]
 
     def act_test(self, mpf='./mapping.json', model_root='./',
                  thre=0.4, matched_out='/www/experiments/'):
@@ -255,19 +391,17 @@ class DEMO(oftools.OpenFace):
                             new_name=None)
                         found = True
             else:
-                for p in range(0, len(r1['prob'])):
-                    prob = r1['prob'][p]
-                    vmax = max(prob)
-                    imax = prob.argmax()
-                    if vmax > thre:
-                        if imax == cat:
-                            path = res['path'][i]
-                            self.pl.patch_rectangle_img(
-                                path, res['pos'][i][p],
-                                new_home=new_home)
-                            found = True
-                        else:
-                            mis_match = True
+                probs = np.asarray(r1['prob'])
+                imaxes = probs.argmax(axis=1)
+                passing = np.where(probs.max(axis=1) > thre)[0]
+                hits = passing[imaxes[passing] == cat]
+                mis_match = len(hits) < len(passing)
+                for p in hits:
+                    path = res['path'][i]
+                    self.pl.patch_rectangle_img(
+                        path, res['pos'][i][p],
+                        new_home=new_home)
+                    found = True
             if found:
                 match += 1
             if mis_match:
@@ -282,52 +416,32 @@ class DEMO(oftools.OpenFace):
         print('[openface_demo] Images with roi are saved to %s' % new_home)
 
 
+# action name: DEMO method, whether it needs set_classifier and
+# how its parameters are built from the command line arguments
+_ACTION_SPEC = {
+    'reps': {'action': DEMO.act_reps, 'needs_classifier': False,
+             'params': lambda a: {'dir_path': a.workdir}},
+    'train': {'action': DEMO.act_train, 'needs_classifier': True,
+              'params': lambda a: {}},
+    'test': {'action': DEMO.act_test, 'needs_classifier': True,
+             'params': lambda a: {'thre': a.pcut, 'mpf': a.mpf,
+                                  'model_root': a.model_path}},
+    'predict': {'action': DEMO.act_predict, 'needs_classifier': True,
+                'params': lambda a: {'mpf': a.mpf,
+                                     'model_root': a.model_path,
+                                     'dir_path': a.workdir}},
+    'pca': {'action': DEMO.act_pca, 'needs_classifier': False,
+            'params': lambda a: {'mpf': a.mpf}},
+    'compare_dir': {'action': DEMO.act_compare_dir,
+                    'needs_classifier': False,
+                    'params': lambda a: {'dir_path': a.workdir}},
+    'compare': {'action': DEMO.act_compare, 'needs_classifier': False,
+                'params': lambda a: {'img1': a.img1, 'img2': a.img2}}
+}
+
+
 def main():
-    parser = argparse.ArgumentParser(
-        description="Simple Openface Demo"
-        )
-    parser.add_argument(
-        "-a", "--action", type=str, default='reps',
-        help="Action to be taken reps(default)" +
-             "/train/test/predict/pca/compare_dir/compare"
-        )
-    parser.add_argument(
-        "-c", "--classifier", type=str, default='SVC',
-        help="Classifier to be used SVC(default)/Neighbors/RF"
-        )
-    parser.add_argument(
-        "-p", "--pcut", type=float, default=0.4,
-        help="Probability cut to be applied to the classifier" +
-             " (default: 0.4, used by action=test)"
-        )
-    parser.add_argument(
-        "--mpf", type=str, default='./mapping.json',
-        help="Path of the mapping file which is generated by action=train" +
-             " (default: ./mapping.json, used by action=test/predict/pca)"
-        )
-    parser.add_argument(
-        "--img1", type=str,
-        help="Path of the first image passed to act_compare"
-        )
-    parser.add_argument(
-        "--img2", type=str,
-        help="Path of the first image passed to act_compare"
-        )
-    parser.add_argument(
-        "--model-path", dest='model_path', type=str, default='./',
-        help="Root directory of the model pickle files" +
-             " (default: ./ , used by action=test/predict)"
-        )
-    parser.add_argument(
-        "-d", "--dbpath", type=str, default='/www/database/db/',
-        help="Path of dbs which are generated by action=rep"
-             " (default: /www/database/db/)"
-        )
-    parser.add_argument(
-        "-w", "--workdir", type=str, default=None,
-        help="Working directory where the images are stored." +
-             " (default: $PWD, used by action=predict/compare_dir)"
-        )
+    parser = _get_parser()
 
     pfs = ['openface.json', 'ml.json']
 
@@ -342,31 +456,10 @@ def main():
     if args.workdir is None:
         args.workdir = os.getcwd()
 
-    parms = {}
-
-    if args.action == 'rep':
-        parms['dir_path'] = args.workdir
-    elif args.action == 'pca':
-        parms['mpf'] = args.mpf
-    elif args.action == 'predict':
+    spec = _ACTION_SPEC[args.action]
+    if spec['needs_classifier']:
         demo.set_classifier(args.classifier)
-        parms['mpf'] = args.mpf
-        parms['model_root'] = args.model_path
-        parms['dir_path'] = args.workdir
-    elif args.action == 'test':
-        demo.set_classifier(args.classifier)
-        parms['thre'] = args.pcut
-        parms['mpf'] = args.mpf
-        parms['model_root'] = args.model_path
-    elif args.action == 'train':
-        demo.set_classifier(args.classifier)
-    elif args.action == 'compare_dir':
-        parms['dir_path'] = args.workdir
-    elif args.action == 'compare':
-        parms['img1'] = args.img1
-        parms['img2'] = args.img2
-
-    getattr(demo, 'act_' + args.action)(**parms)
+    spec['action'](demo, **spec['params'](args))
 
 if __name__ == '__main__':
     main()
@@ -41,10 +41,11 @@ for fimg in imgs:
     img = np.expand_dims(img, axis=0)
 
     layers_extract = [3, 8, 15, 22, 29]
+    # hc has shape (224*224, C), one row per pixel
     hc = mdls.extract_hypercolumn(model, layers_extract, img)
-    # new_shape = 224*224
-    # ave = np.average(hc.transpose(1, 2, 0), axis=2).reshape(new_shape)
+    # ave = np.average(hc, axis=1)
     # X.append(ave)
-    X.append(hc.ravel())
+    # channel-major features, same order as the former (C, 224, 224) output
+    X.append(hc.T.ravel())
 
 mf = mlr.run(X, Y)